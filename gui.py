@@ -1,49 +1,104 @@
 # -*- coding: utf-8 -*-
 """BNB4 Model Converter v2.0 — GUI для квантования HuggingFace моделей в 4-бит."""
 
+import gc
+import os
 import sys
+import multiprocessing
 import json
+import struct
+import subprocess
 import traceback
 import warnings
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from multiprocessing import Process, Event, Pipe, set_start_method
-import torch
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 
 warnings.filterwarnings('ignore', category=FutureWarning)
 warnings.filterwarnings('ignore', message=r'.*Xet Storage.*')
 
-try:
-    set_start_method('spawn', force=True)
-except RuntimeError:
-    pass
+# Сообщения worker → GUI: 1 байт тега + полезная нагрузка (без pickle)
+MSG_LOG, MSG_PROGRESS, MSG_STATUS, MSG_DONE = b'L', b'P', b'S', b'D'
+PROGRESS_FMT = struct.Struct('<f')
+
+# Файлы токенизатора/процессора — скачиваются параллельно с весами модели
+PREFETCH_PATTERNS = [
+    'tokenizer*', 'tokenization_*', 'special_tokens*', 'vocab*', 'merges*',
+    '*processor*', 'preprocessor*', 'image_processing_*', 'processing_*',
+    'chat_template*', 'added_tokens*',
+]
+
+# bnb4 работает только на CUDA, поэтому CPU в списке устройств нет
+DEVICE_CHOICES = ["auto", "balanced_low_0", "gpu"]
+
+# Ограничение истории журнала: при превышении удаляются самые старые строки
+LOG_MAX_LINES = 5000
+LOG_TRIM_LINES = 1000
+
+# Оценка VRAM для bnb4: ~0.55 байта на параметр + запас на CUDA-контекст и буферы
+BNB4_BYTES_PER_PARAM = 0.55
+VRAM_OVERHEAD_GB = 2
+
+
+def query_gpu_memory():
+    """Список (used, total, free) в МиБ по каждой GPU через nvidia-smi; [] если недоступно."""
+    try:
+        r = subprocess.run(['nvidia-smi', '--query-gpu=memory.used,memory.total,memory.free', '--format=csv,noheader,nounits'],
+                           capture_output=True, text=True, timeout=2)
+        if r.returncode != 0:
+            return []
+        return [tuple(map(float, line.split(','))) for line in r.stdout.strip().splitlines()]
+    except Exception:
+        return []
+
+
+def parse_params(params):
+    """'7B' → 7e9, '600M' → 6e8; None для нераспознанных значений ('?')."""
+    scale = {'B': 1e9, 'M': 1e6}.get(params[-1:].upper())
+    try:
+        return float(params[:-1]) * scale if scale else None
+    except ValueError:
+        return None
 
 
 def download_worker(cfg, conn, stop_evt):
     """Worker-процесс: загрузка модели, квантование, сохранение."""
+    import importlib.util
+    # Переменные читаются huggingface_hub при импорте — задаём до transformers.
+    # hf_transfer включаем только если пакет установлен, иначе hub падает на загрузке.
+    if importlib.util.find_spec('hf_transfer') is not None:
+        os.environ.setdefault('HF_HUB_ENABLE_HF_TRANSFER', '1')
+    os.environ.setdefault('HF_HUB_DOWNLOAD_TIMEOUT', '60')
+
+    import torch
     from transformers import (
         AutoModelForImageTextToText, AutoModelForCausalLM,
         AutoModel, AutoTokenizer, AutoImageProcessor,
         BitsAndBytesConfig, AutoConfig
     )
+    from huggingface_hub import snapshot_download
+    from accelerate.hooks import remove_hook_from_module
 
     def send_log(msg):
         if stop_evt.is_set():
             raise KeyboardInterrupt()
-        conn.send(('log', msg))
+        conn.send_bytes(MSG_LOG + msg.encode('utf-8'))
 
     def send_progress(pct, stage=""):
         if stop_evt.is_set():
             raise KeyboardInterrupt()
-        conn.send(('progress', pct, stage))
+        conn.send_bytes(MSG_PROGRESS + PROGRESS_FMT.pack(pct) + stage.encode('utf-8'))
 
     def send_status(status):
         if stop_evt.is_set():
             raise KeyboardInterrupt()
-        conn.send(('status', status))
+        conn.send_bytes(MSG_STATUS + status.encode('utf-8'))
 
+    prefetch_pool = ThreadPoolExecutor(max_workers=1)
+    ok = False
     try:
         url = cfg['TARGET_MODEL_URL']
         repo = url.rstrip('/').split('/')[-1]
@@ -54,20 +109,34 @@ def download_worker(cfg, conn, stop_evt):
         send_status("Инициализация")
         send_progress(0)
 
+        # bnb4-ядра работают только на CUDA: без GPU transformers молча сохранил бы FP16
         device_map = cfg.get('DEVICE', 'auto')
-        if device_map == 'cpu':
-            send_log("🖥 CPU")
-        elif device_map == 'cuda':
+        if device_map == 'cpu' or not torch.cuda.is_available():
+            raise RuntimeError("bnb4 требует NVIDIA GPU с CUDA — конвертация на CPU не поддерживается")
+        if device_map in ('cuda', 'gpu'):
+            device_map = "cuda"
             send_log("🎮 GPU")
+        elif device_map == 'balanced_low_0':
+            send_log("⚖ Multi-GPU, GPU0 разгружен")
         else:
             device_map = "auto"
-            send_log("🔄 Auto device")
+            # "auto" заполняет GPU0 целиком — на нескольких картах распределяем равномерно
+            if torch.cuda.device_count() > 1:
+                device_map = "balanced"
+                send_log(f"⚖ Multi-GPU ({torch.cuda.device_count()}), balanced")
+            else:
+                send_log("🔄 Auto device")
+
+        # Мелкие файлы токенизатора/процессора качаем в фоне, пока грузятся веса
+        prefetch = prefetch_pool.submit(snapshot_download, url, allow_patterns=PREFETCH_PATTERNS)
 
         # Автоопределение типа модели
         model_type = cfg.get('MODEL_TYPE', 'auto')
+        # Для моделей с нативной поддержкой в transformers удалённый код не подгружаем
+        trust_remote_code = cfg.get('TRUST_REMOTE_CODE', True)
         if model_type == 'auto':
             try:
-                hf_config = AutoConfig.from_pretrained(url, trust_remote_code=True)
+                hf_config = AutoConfig.from_pretrained(url, trust_remote_code=trust_remote_code)
                 arch = hf_config.architectures or []
                 if any('Vision' in str(a) or 'ImageText' in str(a) for a in arch):
                     model_type = 'vision'
@@ -81,65 +150,48 @@ def download_worker(cfg, conn, stop_evt):
                 model_type = 'text'
 
         # Конфигурация квантования
-        compute_dtype = torch.float16
-        if device_map != "cpu" and torch.cuda.is_available() and torch.cuda.is_bf16_supported():
-            compute_dtype = torch.bfloat16
+        compute_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
 
         bnb_config = BitsAndBytesConfig(
             load_in_4bit=True,
             bnb_4bit_use_double_quant=True,
             bnb_4bit_quant_type=cfg.get('QUANT_TYPE', 'nf4'),
-            bnb_4bit_compute_dtype=compute_dtype
+            bnb_4bit_compute_dtype=compute_dtype,
+            # Хранение 4-бит весов в bf16 (Ampere+) — быстрый путь matmul_4bit; иначе uint8 по умолчанию
+            bnb_4bit_quant_storage=compute_dtype if cfg.get('BF16_STORAGE') else torch.uint8
         )
 
         send_status("Загрузка модели")
         send_progress(15)
 
-        # 3-этапный fallback загрузки
-        model = None
-        errors = []
-
-        # Попытка 1 — по типу модели
+        # 3-этапный fallback загрузки: следующий класс пробуем только если auto-класс
+        # не знает конфиг модели ("Unrecognized configuration class") — это происходит
+        # до загрузки весов. Остальные ошибки (OOM, несовпадение форм, диспетчеризация
+        # на CPU/диск, сеть) пробрасываются сразу, чтобы не загружать веса повторно.
         if model_type == 'vision':
-            try:
-                model = AutoModelForImageTextToText.from_pretrained(
-                    url, quantization_config=bnb_config if device_map != "cpu" else None,
-                    device_map=device_map, trust_remote_code=True,
-                    torch_dtype=compute_dtype if device_map == "cpu" else None)
-                send_log("📦 AutoModelForImageTextToText ✅")
-            except Exception as e:
-                errors.append(str(e))
+            candidates = [AutoModelForImageTextToText, AutoModelForCausalLM, AutoModel]
         elif model_type == 'embedding':
-            try:
-                model = AutoModel.from_pretrained(
-                    url, quantization_config=bnb_config if device_map != "cpu" else None,
-                    device_map=device_map, trust_remote_code=True,
-                    torch_dtype=compute_dtype if device_map == "cpu" else None)
-                send_log("📦 AutoModel (embedding) ✅")
-            except Exception as e:
-                errors.append(str(e))
+            candidates = [AutoModel, AutoModelForCausalLM]
+        else:
+            candidates = [AutoModelForCausalLM, AutoModel]
 
-        # Попытка 2 — CausalLM
-        if model is None:
-            try:
-                model = AutoModelForCausalLM.from_pretrained(
-                    url, quantization_config=bnb_config if device_map != "cpu" else None,
-                    device_map=device_map, trust_remote_code=True,
-                    torch_dtype=compute_dtype if device_map == "cpu" else None)
-                send_log("📦 AutoModelForCausalLM ✅")
-            except Exception as e:
-                errors.append(str(e))
+        load_kwargs = dict(
+            quantization_config=bnb_config, device_map=device_map,
+            trust_remote_code=trust_remote_code, low_cpu_mem_usage=True)
 
-        # Попытка 3 — универсальный AutoModel
-        if model is None:
+        model = None
+        errors = []
+        for auto_cls in candidates:
             try:
-                model = AutoModel.from_pretrained(
-                    url, quantization_config=bnb_config if device_map != "cpu" else None,
-                    device_map=device_map, trust_remote_code=True,
-                    torch_dtype=compute_dtype if device_map == "cpu" else None)
-                send_log("📦 AutoModel ✅")
-            except Exception as e:
-                errors.append(str(e))
+                model = auto_cls.from_pretrained(url, **load_kwargs)
+                send_log(f"📦 {auto_cls.__name__} ✅")
+                break
+            except (KeyError, ValueError) as e:
+                if "Unrecognized configuration class" not in str(e):
+                    raise
+                errors.append(f"{auto_cls.__name__}: {e}")
+                gc.collect()
+                torch.cuda.empty_cache()
 
         if model is None:
             raise RuntimeError("Не удалось загрузить модель.\n" + "\n".join(f"- {e}" for e in errors))
@@ -147,9 +199,13 @@ def download_worker(cfg, conn, stop_evt):
         # Токенизатор
         send_status("Токенизатор")
         send_progress(40)
+        try:
+            prefetch.result()
+        except Exception as e:
+            send_log(f"⚠ Предзагрузка токенизатора не удалась: {e}")
         tokenizer = None
         try:
-            tokenizer = AutoTokenizer.from_pretrained(url, trust_remote_code=True)
+            tokenizer = AutoTokenizer.from_pretrained(url, trust_remote_code=trust_remote_code)
         except Exception as e:
             send_log(f"⚠ Токенизатор не найден: {e}")
 
@@ -159,15 +215,22 @@ def download_worker(cfg, conn, stop_evt):
             try:
                 send_status("Процессор изображений")
                 send_progress(55)
-                image_processor = AutoImageProcessor.from_pretrained(url, trust_remote_code=True)
+                image_processor = AutoImageProcessor.from_pretrained(url, trust_remote_code=trust_remote_code)
             except Exception:
                 pass
 
         # Очистка памяти
         send_status("Очистка памяти")
         send_progress(70)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        # Хуки accelerate (module._hf_hook + обёрнутый forward) для сохранения не нужны —
+        # снимаем их вместе с конфигом квантования и освобождаем VRAM до сохранения
+        del bnb_config, load_kwargs
+        remove_hook_from_module(model, recurse=True)
+        gc.collect()
+        for device in range(torch.cuda.device_count()):
+            torch.cuda.synchronize(device)
+        torch.cuda.empty_cache()
+        torch.cuda.ipc_collect()
 
         # Сохранение
         final_path = out_dir / f"{repo}-bnb4"
@@ -175,7 +238,8 @@ def download_worker(cfg, conn, stop_evt):
         send_status("Сохранение")
         send_progress(85)
 
-        model.save_pretrained(final_path, safe_serialization=cfg.get('SAFE_SERIALIZATION', True))
+        # safetensors всегда: bnb4-веса сериализуются корректно и грузятся через mmap
+        model.save_pretrained(final_path, safe_serialization=True, max_shard_size="2GB")
         send_log(f"💾 {final_path}")
 
         if tokenizer:
@@ -186,29 +250,40 @@ def download_worker(cfg, conn, stop_evt):
         send_log("✅ Модель успешно сохранена")
         send_status("Готово")
         send_progress(100)
+        ok = True
 
     except KeyboardInterrupt:
         send_log("⏹ Прервано пользователем")
     except Exception as e:
         send_log(f"❌ {e}\n{traceback.format_exc()}")
     finally:
-        conn.send(('done', None))
+        prefetch_pool.shutdown(wait=False, cancel_futures=True)
+        conn.send_bytes(MSG_DONE + (b'\x01' if ok else b'\x00'))
         conn.close()
 
 
 class ConverterGUI:
+    SETTINGS_FILE = Path("gui_settings.json")
+
     def __init__(self, root):
         self.root = root
         self._setup_window()
         self._define_models()
         self.proc = None
-        self.stop_evt = Event()
-        self.parent_conn, self.child_conn = Pipe()
+        # Собственный spawn-контекст вместо глобального set_start_method
+        self._mp = multiprocessing.get_context('spawn')
+        self.stop_evt = self._mp.Event()
+        # Канал создаётся заново на каждый запуск в start()
+        self.parent_conn = None
+        self._pipe_poll_id = None
         self.vram_running = False
+        # Последний результат фонового опроса nvidia-smi — используется и для проверки VRAM в start()
+        self._last_gpus = []
+        self._log_buf = deque()
+        self._log_flush_id = None
         self.build_ui()
         self.load_settings()
         self.redirect_output()
-        self.check_pipe()
         self.start_vram_monitor()
 
     def _setup_window(self):
@@ -235,47 +310,48 @@ class ConverterGUI:
                 "Qwen3.5-9B": {"url": "Qwen/Qwen3.5-9B", "type": "auto", "params": "9B", "desc": "Полноразмерная Qwen 3.5"},
             },
             "🤖 Qwen 3": {
-                "Qwen3-0.6B": {"url": "Qwen/Qwen3-0.6B", "type": "auto", "params": "0.6B", "desc": "Ультра-лёгкая Qwen 3"},
-                "Qwen3-1.7B": {"url": "Qwen/Qwen3-1.7B", "type": "auto", "params": "1.7B", "desc": "Лёгкая Qwen 3"},
-                "Qwen3-4B": {"url": "Qwen/Qwen3-4B", "type": "auto", "params": "4B", "desc": "Средняя Qwen 3"},
-                "Qwen3-8B": {"url": "Qwen/Qwen3-8B", "type": "auto", "params": "8B", "desc": "Полноразмерная Qwen 3"},
-                "Qwen3-Emb-0.6B": {"url": "Qwen/Qwen3-Embedding-0.6B", "type": "embedding", "params": "0.6B", "desc": "Embedding Qwen 3"},
-                "Qwen3-Emb-4B": {"url": "Qwen/Qwen3-Embedding-4B", "type": "embedding", "params": "4B", "desc": "Embedding Qwen 3"},
+                "Qwen3-0.6B": {"url": "Qwen/Qwen3-0.6B", "type": "auto", "params": "0.6B", "trust_remote_code": False, "desc": "Ультра-лёгкая Qwen 3"},
+                "Qwen3-1.7B": {"url": "Qwen/Qwen3-1.7B", "type": "auto", "params": "1.7B", "trust_remote_code": False, "desc": "Лёгкая Qwen 3"},
+                "Qwen3-4B": {"url": "Qwen/Qwen3-4B", "type": "auto", "params": "4B", "trust_remote_code": False, "desc": "Средняя Qwen 3"},
+                "Qwen3-8B": {"url": "Qwen/Qwen3-8B", "type": "auto", "params": "8B", "trust_remote_code": False, "desc": "Полноразмерная Qwen 3"},
+                "Qwen3-Emb-0.6B": {"url": "Qwen/Qwen3-Embedding-0.6B", "type": "embedding", "params": "0.6B", "trust_remote_code": False, "desc": "Embedding Qwen 3"},
+                "Qwen3-Emb-4B": {"url": "Qwen/Qwen3-Embedding-4B", "type": "embedding", "params": "4B", "trust_remote_code": False, "desc": "Embedding Qwen 3"},
             },
             "🖼️ Vision-Language": {
                 "MinerU2.5-Pro-1.2B": {"url": "opendatalab/MinerU2.5-Pro-2604-1.2B", "type": "vision", "params": "1.2B", "desc": "OCR от opendatalab"},
-                "Qwen2.5-VL-7B": {"url": "Qwen/Qwen2.5-VL-7B-Instruct", "type": "vision", "params": "7B", "desc": "VL Qwen"},
-                "Qwen2.5-VL-3B": {"url": "Qwen/Qwen2.5-VL-3B-Instruct", "type": "vision", "params": "3B", "desc": "Лёгкая VL Qwen"},
-                "MiniCPM-V-4.5": {"url": "openbmb/MiniCPM-V-4_5", "type": "vision", "params": "8B", "desc": "VL MiniCPM"},
-                "GLM-4V-9B": {"url": "THUDM/glm-4v-9b", "type": "vision", "params": "9B", "desc": "VL THUDM"},
-                "InternVL2-8B": {"url": "OpenGVLab/InternVL2-8B", "type": "vision", "params": "8B", "desc": "VL OpenGVLab"},
-                "NuMarkdown-8B": {"url": "numind/NuMarkdown-8B-Thinking", "type": "vision", "params": "8B", "desc": "OCR для документов"},
-                "DeepSeek-OCR-2": {"url": "deepseek-ai/DeepSeek-OCR-2", "type": "vision", "params": "3B", "desc": "OCR DeepSeek"},
+                "Qwen2.5-VL-7B": {"url": "Qwen/Qwen2.5-VL-7B-Instruct", "type": "vision", "params": "7B", "trust_remote_code": False, "desc": "VL Qwen"},
+                "Qwen2.5-VL-3B": {"url": "Qwen/Qwen2.5-VL-3B-Instruct", "type": "vision", "params": "3B", "trust_remote_code": False, "desc": "Лёгкая VL Qwen"},
+                "MiniCPM-V-4.5": {"url": "openbmb/MiniCPM-V-4_5", "type": "vision", "params": "8B", "trust_remote_code": True, "desc": "VL MiniCPM"},
+                "GLM-4V-9B": {"url": "THUDM/glm-4v-9b", "type": "vision", "params": "9B", "trust_remote_code": True, "desc": "VL THUDM"},
+                "InternVL2-8B": {"url": "OpenGVLab/InternVL2-8B", "type": "vision", "params": "8B", "trust_remote_code": True, "desc": "VL OpenGVLab"},
+                "NuMarkdown-8B": {"url": "numind/NuMarkdown-8B-Thinking", "type": "vision", "params": "8B", "trust_remote_code": False, "desc": "OCR для документов"},
+                "DeepSeek-OCR-2": {"url": "deepseek-ai/DeepSeek-OCR-2", "type": "vision", "params": "3B", "trust_remote_code": True, "desc": "OCR DeepSeek"},
             },
             "🌐 Перевод": {
                 "Hunyuan-MT-7B": {"url": "tencent/Hunyuan-MT-7B", "type": "text", "params": "7B", "desc": "Переводчик Tencent"},
                 "Hunyuan-MT-Chimera": {"url": "tencent/Hunyuan-MT-Chimera-7B", "type": "text", "params": "7B", "desc": "Ансамбль перевод"},
-                "NLLB-600M": {"url": "facebook/nllb-200-distilled-600M", "type": "text", "params": "600M", "desc": "Meta NLLB лёгкий"},
-                "M2M100-12B": {"url": "facebook/m2m100_12B", "type": "text", "params": "12B", "desc": "Meta M2M100"},
+                "NLLB-600M": {"url": "facebook/nllb-200-distilled-600M", "type": "text", "params": "600M", "trust_remote_code": False, "desc": "Meta NLLB лёгкий"},
+                "M2M100-12B": {"url": "facebook/m2m100_12B", "type": "text", "params": "12B", "trust_remote_code": False, "desc": "Meta M2M100"},
             },
             "🧠 LLM": {
-                "Qwen2.5-0.5B": {"url": "Qwen/Qwen2.5-0.5B-Instruct", "type": "auto", "params": "0.5B", "desc": "Ультра-лёгкая Qwen"},
-                "Qwen2.5-1.5B": {"url": "Qwen/Qwen2.5-1.5B-Instruct", "type": "auto", "params": "1.5B", "desc": "Лёгкая Qwen"},
-                "Qwen2.5-3B": {"url": "Qwen/Qwen2.5-3B-Instruct", "type": "auto", "params": "3B", "desc": "Средняя Qwen"},
-                "Qwen2.5-7B": {"url": "Qwen/Qwen2.5-7B-Instruct", "type": "auto", "params": "7B", "desc": "Qwen Instruct"},
-                "Qwen2.5-14B": {"url": "Qwen/Qwen2.5-14B-Instruct", "type": "auto", "params": "14B", "desc": "Qwen 14B"},
-                "Mistral-7B-v0.3": {"url": "mistralai/Mistral-7B-Instruct-v0.3", "type": "auto", "params": "7B", "desc": "Mistral AI"},
-                "Llama-3.2-1B": {"url": "meta-llama/Llama-3.2-1B-Instruct", "type": "auto", "params": "1B", "desc": "Llama лёгкая"},
-                "Llama-3.2-3B": {"url": "meta-llama/Llama-3.2-3B-Instruct", "type": "auto", "params": "3B", "desc": "Llama средняя"},
-                "Llama-3.1-8B": {"url": "meta-llama/Llama-3.1-8B-Instruct", "type": "auto", "params": "8B", "desc": "Llama 8B"},
-                "Gemma-2-2B": {"url": "google/gemma-2-2b", "type": "auto", "params": "2B", "desc": "Gemma 2 лёгкая"},
-                "Gemma-2-9B": {"url": "google/gemma-2-9b", "type": "auto", "params": "9B", "desc": "Gemma 2"},
-                "Phi-3.5-mini": {"url": "microsoft/Phi-3.5-mini-instruct", "type": "auto", "params": "3.8B", "desc": "Phi-3.5 Microsoft"},
+                "Qwen2.5-0.5B": {"url": "Qwen/Qwen2.5-0.5B-Instruct", "type": "auto", "params": "0.5B", "trust_remote_code": False, "desc": "Ультра-лёгкая Qwen"},
+                "Qwen2.5-1.5B": {"url": "Qwen/Qwen2.5-1.5B-Instruct", "type": "auto", "params": "1.5B", "trust_remote_code": False, "desc": "Лёгкая Qwen"},
+                "Qwen2.5-3B": {"url": "Qwen/Qwen2.5-3B-Instruct", "type": "auto", "params": "3B", "trust_remote_code": False, "desc": "Средняя Qwen"},
+                "Qwen2.5-7B": {"url": "Qwen/Qwen2.5-7B-Instruct", "type": "auto", "params": "7B", "trust_remote_code": False, "desc": "Qwen Instruct"},
+                "Qwen2.5-14B": {"url": "Qwen/Qwen2.5-14B-Instruct", "type": "auto", "params": "14B", "trust_remote_code": False, "desc": "Qwen 14B"},
+                "Mistral-7B-v0.3": {"url": "mistralai/Mistral-7B-Instruct-v0.3", "type": "auto", "params": "7B", "trust_remote_code": False, "desc": "Mistral AI"},
+                "Llama-3.2-1B": {"url": "meta-llama/Llama-3.2-1B-Instruct", "type": "auto", "params": "1B", "trust_remote_code": False, "desc": "Llama лёгкая"},
+                "Llama-3.2-3B": {"url": "meta-llama/Llama-3.2-3B-Instruct", "type": "auto", "params": "3B", "trust_remote_code": False, "desc": "Llama средняя"},
+                "Llama-3.1-8B": {"url": "meta-llama/Llama-3.1-8B-Instruct", "type": "auto", "params": "8B", "trust_remote_code": False, "desc": "Llama 8B"},
+                "Gemma-2-2B": {"url": "google/gemma-2-2b", "type": "auto", "params": "2B", "trust_remote_code": False, "desc": "Gemma 2 лёгкая"},
+                "Gemma-2-9B": {"url": "google/gemma-2-9b", "type": "auto", "params": "9B", "trust_remote_code": False, "desc": "Gemma 2"},
+                "Phi-3.5-mini": {"url": "microsoft/Phi-3.5-mini-instruct", "type": "auto", "params": "3.8B", "trust_remote_code": False, "desc": "Phi-3.5 Microsoft"},
             },
             "⚙️ Своя модель": {
                 "Своя модель": {"url": "", "type": "auto", "params": "?", "desc": "Введите URL вручную"},
             },
         }
+        self._model_index = {name: meta for group in self.model_groups.values() for name, meta in group.items()}
 
     def build_ui(self):
         ttk.Label(self.root, text="BNB4 Конвертер моделей v2.0", style='Title.TLabel').pack(anchor="w", padx=15, pady=(15, 4))
@@ -312,7 +388,9 @@ class ConverterGUI:
         ttk.Combobox(params_frame, textvariable=self.quant_var, values=["nf4","fp4"], state="readonly", width=10).grid(row=0, column=3, sticky="w")
         ttk.Label(params_frame, text="Устройство:").grid(row=0, column=4, sticky="w", padx=(16, 6))
         self.device_var = tk.StringVar(value="auto")
-        ttk.Combobox(params_frame, textvariable=self.device_var, values=["auto","gpu","cpu"], state="readonly", width=10).grid(row=0, column=5, sticky="w")
+        ttk.Combobox(params_frame, textvariable=self.device_var, values=DEVICE_CHOICES, state="readonly", width=14).grid(row=0, column=5, sticky="w")
+        self.bf16_storage_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(params_frame, text="Оптимизация для Ampere+ (bf16 storage)", variable=self.bf16_storage_var).grid(row=1, column=0, columnspan=6, sticky="w", pady=(6, 0))
 
         output_frame = ttk.LabelFrame(self.root, text=" Папка сохранения", padding=10)
         output_frame.pack(fill="x", padx=15, pady=(0, 6))
@@ -371,10 +449,7 @@ class ConverterGUI:
         selected = self.model_var.get().strip()
         if not selected or selected.startswith("──"):
             return None
-        for group_models in self.model_groups.values():
-            if selected in group_models:
-                return group_models[selected]
-        return None
+        return self._model_index.get(selected)
 
     def on_model_change(self, _=None):
         info = self.get_model_info()
@@ -418,12 +493,31 @@ class ConverterGUI:
         sys.stderr = LogStream(self.log_msg)
 
     def log_msg(self, msg):
+        # Строки копятся в буфере и выводятся пачкой не чаще раза в 100 мс
+        self._log_buf.append(msg.rstrip("\n"))
+        if self._log_flush_id is None:
+            self._log_flush_id = self.root.after(100, self._flush_log)
+
+    def _flush_log(self):
+        self._log_flush_id = None
+        if not self._log_buf:
+            return
+        txt = "\n".join(self._log_buf)
+        self._log_buf.clear()
         self.log.config(state="normal")
-        self.log.insert("end", msg if msg.endswith("\n") else msg + "\n")
+        self.log.insert("end", txt + "\n")
+        count = int(self.log.index("end-1c").split(".")[0])
+        if count > LOG_MAX_LINES:
+            # Одна пачка может добавить больше LOG_TRIM_LINES строк — режем до лимита с запасом
+            self.log.delete("1.0", f"{count - LOG_MAX_LINES + LOG_TRIM_LINES + 1}.0")
         self.log.see("end")
+        self.log.config(state="disabled")
 
     def clear_log(self):
+        self._log_buf.clear()
+        self.log.config(state="normal")
         self.log.delete("1.0", "end")
+        self.log.config(state="disabled")
 
     def _copy_log(self):
         self.root.clipboard_clear()
@@ -442,26 +536,46 @@ class ConverterGUI:
         self._update_vram()
 
     def _update_vram(self):
-        try:
-            import subprocess
-            r = subprocess.run(['nvidia-smi','--query-gpu=memory.used,memory.total','--format=csv,noheader,nounits'],
-                             capture_output=True, text=True, timeout=2)
-            if r.returncode == 0:
-                used, total = map(float, r.stdout.strip().split(','))
-                self.vram_label.config(text=f"VRAM: {used/1024:.1f}/{total/1024:.1f} GB ({used/total*100:.0f}%)")
-            else:
-                self.vram_label.config(text="VRAM: N/A")
-        except Exception:
-            self.vram_label.config(text="VRAM: N/A")
+        # nvidia-smi может отвечать секундами — опрашиваем в фоне, чтобы не блокировать окно
+        threading.Thread(target=self._probe_vram_async, daemon=True).start()
+
+    def _probe_vram_async(self):
+        text = "VRAM: N/A"
+        gpus = query_gpu_memory()
+        self._last_gpus = gpus
+        if gpus:
+            used, total, _ = gpus[0]
+            text = f"VRAM: {used/1024:.1f}/{total/1024:.1f} GB ({used/total*100:.0f}%)"
         if self.vram_running:
+            self.root.after(0, lambda: self.vram_label.config(text=text))
             self.root.after(2000, self._update_vram)
 
+    def _check_vram(self, info):
+        """Сравнивает оценку VRAM для bnb4 со свободной памятью до скачивания модели."""
+        params = parse_params(info.get('params', '?'))
+        # Берём данные фонового монитора (не старше ~2 с), чтобы не блокировать окно вызовом nvidia-smi
+        gpus = self._last_gpus
+        if not params or not gpus:
+            return True
+        # "gpu" грузит всё на GPU0, auto/balanced распределяют по всем картам
+        free_mib = gpus[0][2] if self.device_var.get() == 'gpu' else sum(g[2] for g in gpus)
+        free_gb = free_mib / 1024
+        req_gb = params * BNB4_BYTES_PER_PARAM / 1e9 + VRAM_OVERHEAD_GB
+        if free_gb >= req_gb:
+            return True
+        return messagebox.askyesno(
+            "Недостаточно VRAM",
+            f"Для {info['params']} в bnb4 нужно ~{req_gb:.1f} GB VRAM, свободно {free_gb:.1f} GB.\n"
+            "Рекомендуется выбрать модель меньшего размера.\n\nВсё равно продолжить?")
+
     def start(self):
         url = self.url_var.get().strip()
         if not url:
             messagebox.showerror("Ошибка", "Укажите URL модели")
             return
         info = self.get_model_info() or {}
+        if info.get('url') == url and not self._check_vram(info):
+            return
         self.start_btn.config(state="disabled")
         self.stop_btn.config(state="normal")
         self.progress['value'] = 0
@@ -471,13 +585,21 @@ class ConverterGUI:
             'TARGET_MODEL_URL': url,
             'OUTPUT_PATH': self.out_var.get(),
             'MODEL_TYPE': info.get('type', 'auto'),
+            # Флаг каталога относится только к его URL; для введённого вручную — по умолчанию
+            'TRUST_REMOTE_CODE': info.get('trust_remote_code', True) if info.get('url') == url else True,
             'DEVICE': 'auto' if self.device_var.get() == 'auto' else self.device_var.get(),
             'QUANT_TYPE': self.quant_var.get(),
-            'SAFE_SERIALIZATION': True,
+            'BF16_STORAGE': self.bf16_storage_var.get(),
             'MAX_SEQ_LENGTH': self.ctx_var.get(),
         }
-        self.proc = Process(target=download_worker, args=(cfg, self.child_conn, self.stop_evt), daemon=True)
+        self._unwatch_pipe()
+        # Worker только пишет — однонаправленный канал дешевле дуплексного.
+        # Дочерний конец закрываем сразу после start(), чтобы смерть worker'а давала EOF.
+        self.parent_conn, child_conn = self._mp.Pipe(duplex=False)
+        self.proc = self._mp.Process(target=download_worker, args=(cfg, child_conn, self.stop_evt), daemon=True)
         self.proc.start()
+        child_conn.close()
+        self._watch_pipe()
         self.log_msg(f" Запуск: {url}\n")
 
     def stop(self):
@@ -490,50 +612,99 @@ class ConverterGUI:
             self.status.config(text="Прервано", foreground=self.colors['error'])
             self.log_msg("⏹ Прервано\n")
 
+    def _watch_pipe(self):
+        # На Unix Tk сам следит за дескриптором канала — без холостых пробуждений
+        if hasattr(self.root.tk, 'createfilehandler'):
+            self.root.tk.createfilehandler(self.parent_conn.fileno(), tk.READABLE,
+                                           lambda *_: self._drain_pipe())
+        else:
+            self.check_pipe()
+
     def check_pipe(self):
+        # Windows: createfilehandler недоступен — опрашиваем канал по таймеру
+        self._pipe_poll_id = None
+        self._drain_pipe()
+        if self.parent_conn is not None:
+            self._pipe_poll_id = self.root.after(100, self.check_pipe)
+
+    def _unwatch_pipe(self):
+        if self._pipe_poll_id is not None:
+            self.root.after_cancel(self._pipe_poll_id)
+            self._pipe_poll_id = None
+        if self.parent_conn is not None:
+            if hasattr(self.root.tk, 'deletefilehandler'):
+                self.root.tk.deletefilehandler(self.parent_conn.fileno())
+            self.parent_conn.close()
+            self.parent_conn = None
+
+    def _drain_pipe(self):
         try:
-            while self.parent_conn.poll():
-                msg = self.parent_conn.recv()
-                if isinstance(msg, tuple):
-                    t = msg[0]
-                    if t == 'progress':
-                        self.progress['value'] = msg[1]
-                        if len(msg) > 2 and msg[2]:
-                            self.status.config(text=msg[2], foreground=self.colors['warning'])
-                    elif t == 'log':
-                        self.log_msg(msg[1])
-                    elif t == 'status':
-                        self.status.config(text=msg[1], foreground=self.colors['warning'])
-                    elif t == 'done':
-                        self.start_btn.config(state="normal")
-                        self.stop_btn.config(state="disabled")
+            while self.parent_conn is not None and self.parent_conn.poll():
+                msg = self.parent_conn.recv_bytes()
+                tag, payload = msg[:1], msg[1:]
+                if tag == MSG_PROGRESS:
+                    self.progress['value'] = PROGRESS_FMT.unpack_from(payload)[0]
+                    stage = payload[PROGRESS_FMT.size:].decode('utf-8', 'replace')
+                    if stage:
+                        self.status.config(text=stage, foreground=self.colors['warning'])
+                elif tag == MSG_LOG:
+                    self.log_msg(payload.decode('utf-8', 'replace'))
+                elif tag == MSG_STATUS:
+                    self.status.config(text=payload.decode('utf-8', 'replace'), foreground=self.colors['warning'])
+                elif tag == MSG_DONE:
+                    self._unwatch_pipe()
+                    self.start_btn.config(state="normal")
+                    self.stop_btn.config(state="disabled")
+                    self._flush_log()
+                    if payload == b'\x01':
                         self.status.config(text="✅ Готово!", foreground=self.colors['success'])
                         messagebox.showinfo("Успех", "Модель сконвертирована!")
+                    else:
+                        self.status.config(text="❌ Ошибка", foreground=self.colors['error'])
+        except (EOFError, OSError):
+            # Worker завершился, не отправив MSG_DONE (падение или terminate)
+            self._unwatch_pipe()
+            if str(self.start_btn['state']) == "disabled":
+                self.start_btn.config(state="normal")
+                self.stop_btn.config(state="disabled")
+                self.status.config(text="❌ Процесс завершился аварийно", foreground=self.colors['error'])
+                self.log_msg("❌ Worker-процесс неожиданно завершился")
         except Exception:
             pass
-        self.root.after(100, self.check_pipe)
 
     def load_settings(self):
-        f = "gui_settings.json"
-        if Path(f).exists():
-            try:
-                s = json.loads(Path(f).read_text(encoding='utf-8'))
-                if s.get('model') in self.model_cb['values']:
-                    self.model_cb.set(s['model'])
-                    self.on_model_change()
-                self.out_var.set(s.get('output_path', self.out_var.get()))
-                self.ctx_var.set(s.get('context_length', self.ctx_var.get()))
-                self.device_var.set(s.get('device', 'auto'))
-                self.quant_var.set(s.get('quant_type', 'nf4'))
-            except Exception as e:
-                print(f"Load settings error: {e}")
+        try:
+            s = json.loads(self.SETTINGS_FILE.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError as e:
+            print(f"Load settings error: повреждён {self.SETTINGS_FILE}: {e}")
+            return
+        except Exception as e:
+            print(f"Load settings error: {e}")
+            return
+        try:
+            if s.get('model') in self.model_cb['values']:
+                self.model_cb.set(s['model'])
+                self.on_model_change()
+            self.out_var.set(s.get('output_path', self.out_var.get()))
+            self.ctx_var.set(s.get('context_length', self.ctx_var.get()))
+            device = s.get('device', 'auto')
+            self.device_var.set(device if device in DEVICE_CHOICES else 'auto')
+            self.quant_var.set(s.get('quant_type', 'nf4'))
+            self.bf16_storage_var.set(s.get('bf16_storage', False))
+        except Exception as e:
+            print(f"Load settings error: {e}")
 
     def save_settings(self):
         s = {'model': self.model_cb.get(), 'output_path': self.out_var.get(),
              'context_length': self.ctx_var.get(), 'device': self.device_var.get(),
-             'quant_type': self.quant_var.get()}
+             'quant_type': self.quant_var.get(), 'bf16_storage': self.bf16_storage_var.get()}
         try:
-            Path("gui_settings.json").write_text(json.dumps(s, ensure_ascii=False, indent=2), encoding='utf-8')
+            # Пишем во временный файл и подменяем — падение посреди записи не испортит настройки
+            tmp = self.SETTINGS_FILE.with_name(self.SETTINGS_FILE.name + '.tmp')
+            tmp.write_text(json.dumps(s, ensure_ascii=False, separators=(',', ':')), encoding='utf-8')
+            tmp.replace(self.SETTINGS_FILE)
         except Exception as e:
             print(f"Save settings error: {e}")
 
@@ -57,7 +57,7 @@ echo [3/7] Detecting CUDA and installing PyTorch...
 where nvidia-smi >nul 2>&1
 if %errorlevel% neq 0 (
     echo WARNING: NVIDIA GPU not detected. Will install CPU version of PyTorch.
-    echo The application will work but conversion will be very slow.
+    echo bnb4 conversion requires an NVIDIA GPU with CUDA and will not run on CPU.
     echo.
     echo Installing CPU version of PyTorch...
     pip install torch torchvision torchaudio --index-url https://download.pytorch.org/whl/cpu
@@ -131,6 +131,6 @@ echo.
 echo Notes:
 echo - For Qwen 3.6/3 models: transformers ^>= 4.45.0 required
 echo - MinerU models may require additional OCR dependencies
-echo - CPU mode is supported but will be significantly slower
+echo - An NVIDIA GPU with CUDA is required: bnb4 does not run on CPU
 echo.
 pause